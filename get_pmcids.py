@@ -1,6 +1,9 @@
-import pandas as pd
+import csv
 
-df = pd.read_csv("./meta-analysis.csv")
-df["PMCID"].str.lstrip("PMC").astype(int).to_csv(
-    "./pmcids.txt", index=False, header=None
-)
+with open("./meta-analysis.csv", newline="") as input_stream, open(
+    "./pmcids.txt", "w"
+) as output_stream:
+    output_stream.writelines(
+        f"{int(row['PMCID'].lstrip('PMC'))}\n"
+        for row in csv.DictReader(input_stream)
+    )
@@ -9,26 +9,52 @@ available in XML form through the API).
 It is a scratch proof of concept and offers very limited functionality and
 error handling. As scraping HTML pages is forbidden by PMC this is not meant to
 be widely distributed nor used for large numbers of articles. To avoid
-overloading the PMC website we wait at least 2s and 10s on average between
-requests.
+overloading the PMC website requests are rate-limited (by default to one every
+10s on average) and we back off when the server signals it is throttling us.
+Downloaded pages are cached in `output_dir/cache.sqlite` so they are never
+requested twice; pages downloaded by previous versions, which stored one file
+per page in `output_dir`, are imported into the cache on the first run.
 
 """
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import hashlib
+import itertools
 import json
 import logging
 import pathlib
 import random
+import re
+import sqlite3
+import threading
 import time
+import urllib.parse
+from typing import Optional
 
-import bs4
+import aiohttp
+import lxml.etree
+import lxml.html
 import pandas as pd
 from pubget import _coordinates
-import requests
+import pyarrow as pa
+import pyarrow.parquet
+import zstandard
 
 _LOG_FORMAT = "%(levelname)s\t%(asctime)s\t%(message)s"
 _LOG_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
 _COORD_FIELDS = ("pmcid", "table_id", "x", "y", "z")
+_COORD_SCHEMA = pa.schema(
+    [
+        ("pmcid", pa.int64()),
+        ("table_id", pa.string()),
+        ("x", pa.float64()),
+        ("y", pa.float64()),
+        ("z", pa.float64()),
+    ]
+)
 _HEADERS = {
     "User-Agent": (
         "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0)"
@@ -41,132 +67,525 @@ _HEADERS = {
 }
 _PMC_URL_TEMPLATE = "https://www.ncbi.nlm.nih.gov/pmc/articles/PMC{}"
 _PMC_TABLE_URL_TEMPLATE = f"{_PMC_URL_TEMPLATE}/table/{{}}/?report=objectonly"
+_TABLE_WRAP_IDS_XPATH = lxml.etree.XPath(
+    '//*[contains(concat(" ", normalize-space(@class), " "), " table-wrap ")]'
+    "/@id",
+    smart_strings=False,
+)
+_THREAD_LOCAL = threading.local()
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS articles (
+    pmcid INTEGER PRIMARY KEY, html BLOB NOT NULL, table_ids TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tables (
+    pmcid INTEGER,
+    table_id TEXT,
+    html BLOB NOT NULL,
+    PRIMARY KEY (pmcid, table_id)
+);
+CREATE TABLE IF NOT EXISTS coordinates (
+    pmcid INTEGER PRIMARY KEY, parquet BLOB NOT NULL
+);
+"""
+# only used from the event loop thread: compressors are not thread-safe
+_COMPRESSOR = zstandard.ZstdCompressor()
+_DECOMPRESSOR = zstandard.ZstdDecompressor()
+_WHITESPACE_PATTERN = re.compile(r"[\r\n]+|\s{2,}")
+_PROGRESS_LOG_INTERVAL = 100
+_PROGRESS_LOG_PERIOD = 60.0
+_REQUESTS_PER_SECOND = 0.1
+_MAX_CONCURRENT_REQUESTS = 8
+_MAX_WORKERS = 8
+_CONNECTION_POOL_SIZE = 32
+_KEEPALIVE_TIMEOUT = 30
+_REQUEST_TIMEOUT = 120
+_MAX_RETRIES = 5
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+_TRANSIENT_ERRORS = (
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    asyncio.TimeoutError,
+)
+_BACKOFF_BASE = 10.0
 
 
-def _sleep():
-    delay = 2.0 + random.expovariate(1.0 / 8.0)
-    logging.debug(f"Sleep for {delay:.0f} seconds")
-    time.sleep(delay)
+class _RateLimiter:
+    """Token bucket allowing on average `rate` requests per second.
 
+    At most `capacity` requests can be sent in a burst. `backoff` empties the
+    bucket so that no request is allowed before the given delay has elapsed.
+    """
 
-def _get_article(
-    pmcid: int, session: requests.Session, output_dir: pathlib.Path
-) -> pathlib.Path:
-    output_file = output_dir / f"pmcid_{pmcid}_article.html"
-    if output_file.is_file():
-        return output_file
-    logging.debug(f"Downloading text for PMCID {pmcid}")
-    url = _PMC_URL_TEMPLATE.format(pmcid)
-    _sleep()
-    response = session.get(url)
-    response.raise_for_status()
-    output_file.write_bytes(response.content)
-    return output_file
+    def __init__(self, rate: float, capacity: float = 1.0) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1.0:
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1.0
+
+    def backoff(self, delay: float) -> None:
+        self._refill()
+        self.tokens = min(self.tokens, 1.0 - delay * self.rate)
+
+
+def _get_retry_delay(
+    response: Optional[aiohttp.ClientResponse], attempt: int
+) -> float:
+    try:
+        return float(response.headers["Retry-After"])
+    except (AttributeError, KeyError, ValueError):
+        return _BACKOFF_BASE * 2**attempt + random.random()
+
+
+class _Downloader:
+    """Download pages concurrently, rate-limiting the requests sent to PMC.
+
+    At most `max_concurrent_requests` requests are in flight at any time and
+    all tasks sharing the downloader share one rate limiter per host. When
+    the server is throttling us (429, 503), responds with a transient server
+    error or the connection fails, the host's limiter backs off (using the
+    Retry-After header if present, exponential backoff otherwise) and the
+    request is retried up to `max_retries` times.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        requests_per_second: float = _REQUESTS_PER_SECOND,
+        max_concurrent_requests: int = _MAX_CONCURRENT_REQUESTS,
+        max_retries: int = _MAX_RETRIES,
+    ) -> None:
+        self._session = session
+        self._semaphore = asyncio.Semaphore(max_concurrent_requests)
+        self._max_retries = max_retries
+        self._limiters = collections.defaultdict(
+            lambda: _RateLimiter(requests_per_second)
+        )
+
+    async def get(self, url: str) -> bytes:
+        limiter = self._limiters[urllib.parse.urlsplit(url).netloc]
+        for attempt in itertools.count():
+            async with self._semaphore:
+                await limiter.acquire()
+                try:
+                    async with self._session.get(url) as response:
+                        if (
+                            response.status not in _RETRY_STATUSES
+                            or attempt == self._max_retries
+                        ):
+                            response.raise_for_status()
+                            return await response.read()
+                        reason = f"status {response.status}"
+                        delay = _get_retry_delay(response, attempt)
+                except _TRANSIENT_ERRORS as error:
+                    if attempt == self._max_retries:
+                        raise
+                    reason = repr(error)
+                    delay = _get_retry_delay(None, attempt)
+            logging.warning(
+                f"Request for {url} failed ({reason}), "
+                f"retrying in {delay:.0f} seconds"
+            )
+            limiter.backoff(delay)
+
+
+def _open_cache(output_dir: pathlib.Path) -> sqlite3.Connection:
+    # only used from the event loop thread; lookups and inserts of single
+    # compressed pages are fast enough not to need an executor
+    cache = sqlite3.connect(output_dir / "cache.sqlite", isolation_level=None)
+    cache.execute("PRAGMA journal_mode=WAL")
+    cache.execute("PRAGMA synchronous=NORMAL")
+    cache.executescript(_CACHE_SCHEMA)
+    if cache.execute("PRAGMA user_version").fetchone()[0] == 0:
+        _import_previous_downloads(cache, output_dir)
+    return cache
+
+
+def _import_previous_downloads(
+    cache: sqlite3.Connection, output_dir: pathlib.Path
+) -> None:
+    # previous versions stored each article in pmcid_<pmcid>_article.html and
+    # its tables in pmcid_<pmcid>_tables/<md5(table_id)[:6]>.html; import them
+    # so they are not downloaded again. Coordinates are not imported: they are
+    # extracted again from the imported tables, without network access.
+    article_files = sorted(output_dir.glob("pmcid_*_article.html"))
+    if article_files:
+        logging.info(
+            f"Importing {len(article_files)} articles downloaded by a "
+            f"previous version into {output_dir / 'cache.sqlite'}"
+        )
+    cache.execute("BEGIN")
+    try:
+        for article_file in article_files:
+            pmcid = int(article_file.name.split("_")[1])
+            article_html = article_file.read_bytes()
+            try:
+                table_ids = _parse_table_ids(article_html)
+            except Exception:
+                logging.warning(f"Could not import {article_file}")
+                continue
+            cache.execute(
+                "INSERT OR IGNORE INTO articles VALUES (?, ?, ?)",
+                (
+                    pmcid,
+                    _COMPRESSOR.compress(article_html),
+                    json.dumps(table_ids),
+                ),
+            )
+            tables_dir = output_dir / f"pmcid_{pmcid}_tables"
+            for table_id in table_ids:
+                table_name = hashlib.md5(table_id.encode("UTF-8")).hexdigest()
+                table_file = tables_dir / f"{table_name[:6]}.html"
+                if not table_file.is_file():
+                    continue
+                cache.execute(
+                    "INSERT OR IGNORE INTO tables VALUES (?, ?, ?)",
+                    (
+                        pmcid,
+                        table_id,
+                        _COMPRESSOR.compress(table_file.read_bytes()),
+                    ),
+                )
+        cache.execute("PRAGMA user_version = 1")
+        cache.execute("COMMIT")
+    except BaseException:
+        cache.execute("ROLLBACK")
+        raise
+
+
+def _get_html_parser() -> lxml.html.HTMLParser:
+    # parsers are reused to avoid re-creating the libxml2 parser state for
+    # each document, but lxml serializes the use of a parser so each worker
+    # thread gets its own
+    try:
+        return _THREAD_LOCAL.html_parser
+    except AttributeError:
+        _THREAD_LOCAL.html_parser = lxml.html.HTMLParser(encoding="UTF-8")
+        return _THREAD_LOCAL.html_parser
+
+
+def _parse_table_ids(article_html: bytes) -> list[str]:
+    html = lxml.html.fromstring(article_html, parser=_get_html_parser())
+    return _TABLE_WRAP_IDS_XPATH(html)
 
 
-def _get_table_ids(article_file: pathlib.Path) -> list[str]:
-    html = bs4.BeautifulSoup(article_file.read_text("UTF-8"), "html5lib")
-    table_wraps = html.find_all(class_="table-wrap")
-    table_ids = [tw["id"] for tw in table_wraps]
+async def _get_table_ids(
+    pmcid: int, downloader: _Downloader, cache: sqlite3.Connection
+) -> list[str]:
+    cached = cache.execute(
+        "SELECT table_ids FROM articles WHERE pmcid = ?", (pmcid,)
+    ).fetchone()
+    if cached is not None:
+        return json.loads(cached[0])
+    logging.debug(f"Downloading text for PMCID {pmcid}")
+    url = _PMC_URL_TEMPLATE.format(pmcid)
+    article_html = await downloader.get(url)
+    table_ids = await asyncio.to_thread(_parse_table_ids, article_html)
+    cache.execute(
+        "INSERT OR REPLACE INTO articles VALUES (?, ?, ?)",
+        (pmcid, _COMPRESSOR.compress(article_html), json.dumps(table_ids)),
+    )
     return table_ids
 
 
-def _short_hash(name: str) -> str:
-    return hashlib.md5(name.encode("UTF-8")).hexdigest()[:6]
+async def _get_table(
+    pmcid: int,
+    table_id: str,
+    downloader: _Downloader,
+    cache: sqlite3.Connection,
+) -> bytes:
+    cached = cache.execute(
+        "SELECT html FROM tables WHERE pmcid = ? AND table_id = ?",
+        (pmcid, table_id),
+    ).fetchone()
+    if cached is not None:
+        return _DECOMPRESSOR.decompress(cached[0])
+    logging.debug(f"Downloading PMCID {pmcid} table {table_id}")
+    url = _PMC_TABLE_URL_TEMPLATE.format(pmcid, table_id)
+    table_html = await downloader.get(url)
+    cache.execute(
+        "INSERT OR REPLACE INTO tables VALUES (?, ?, ?)",
+        (pmcid, table_id, _COMPRESSOR.compress(table_html)),
+    )
+    return table_html
 
 
-def _get_tables(
+async def _get_tables(
     pmcid: int,
-    article_file: pathlib.Path,
-    session: requests.Session,
-    output_dir: pathlib.Path,
-) -> pathlib.Path:
-    all_table_ids = _get_table_ids(article_file)
+    all_table_ids: list[str],
+    downloader: _Downloader,
+    cache: sqlite3.Connection,
+) -> dict[str, bytes]:
     logging.debug(f"Found {len(all_table_ids)} tables in PMCID {pmcid}")
-    tables_dir = output_dir / f"pmcid_{pmcid}_tables"
-    tables_dir.mkdir(exist_ok=True)
-    id_info = {}
-    for table_id in all_table_ids:
-        table_name = _short_hash(table_id)
-        id_info[table_name] = table_id
-        table_file = tables_dir / f"{table_name}.html"
-        if table_file.is_file():
-            continue
-        logging.debug(f"Downloading PMCID {pmcid} table {table_id}")
-        url = _PMC_TABLE_URL_TEMPLATE.format(pmcid, table_id)
-        _sleep()
-        response = session.get(url)
-        response.raise_for_status()
-        table_file.write_bytes(response.content)
-    id_info_file = tables_dir / "table_ids.json"
-    id_info_file.write_text(json.dumps(id_info), "UTF-8")
-    return tables_dir
-
-
-def _get_coordinates(
-    pmcid: int, tables_dir: pathlib.Path, output_dir: pathlib.Path
-) -> pathlib.Path:
-    all_table_ids = json.loads(
-        (tables_dir / "table_ids.json").read_text("UTF-8")
+    all_table_ids = list(dict.fromkeys(all_table_ids))
+    all_tables = await asyncio.gather(
+        *(
+            _get_table(pmcid, table_id, downloader, cache)
+            for table_id in all_table_ids
+        )
     )
+    return dict(zip(all_table_ids, all_tables))
+
+
+def _get_cell_text(cell: lxml.html.HtmlElement) -> str:
+    return _WHITESPACE_PATTERN.sub(" ", cell.text_content().strip())
+
+
+def _expand_spans(rows: list[lxml.html.HtmlElement]) -> list[list[str]]:
+    # same layout as pd.read_html: cells spanning several columns or rows are
+    # repeated in each of them
+    all_texts = []
+    remainder: list[tuple[int, str, int]] = []
+    for row in rows:
+        texts = []
+        next_remainder = []
+        index = 0
+        for cell in row.xpath("./td | ./th"):
+            while remainder and remainder[0][0] <= index:
+                prev_index, prev_text, prev_rowspan = remainder.pop(0)
+                texts.append(prev_text)
+                if prev_rowspan > 1:
+                    next_remainder.append(
+                        (prev_index, prev_text, prev_rowspan - 1)
+                    )
+                index += 1
+            text = _get_cell_text(cell)
+            rowspan = int(cell.get("rowspan") or 1)
+            colspan = int(cell.get("colspan") or 1)
+            for _ in range(colspan):
+                texts.append(text)
+                if rowspan > 1:
+                    next_remainder.append((index, text, rowspan - 1))
+                index += 1
+        for prev_index, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append(
+                    (prev_index, prev_text, prev_rowspan - 1)
+                )
+        all_texts.append(texts)
+        remainder = next_remainder
+    while remainder:
+        all_texts.append([text for _, text, _ in remainder])
+        remainder = [
+            (index, text, rowspan - 1)
+            for index, text, rowspan in remainder
+            if rowspan > 1
+        ]
+    return all_texts
+
+
+def _parse_table(table_html: bytes) -> pd.DataFrame:
+    html = lxml.html.fromstring(table_html, parser=_get_html_parser())
+    table = html.xpath("//table")[0]
+    header_rows = table.xpath("./thead/tr")
+    body_rows = table.xpath("./tbody/tr | ./tr")
+    if not header_rows:
+        while body_rows and all(
+            cell.tag == "th" for cell in body_rows[0].xpath("./td | ./th")
+        ):
+            header_rows.append(body_rows.pop(0))
+    body_rows.extend(table.xpath("./tfoot/tr"))
+    header = _expand_spans(header_rows)
+    body = _expand_spans(body_rows)
+    n_columns = max(map(len, header + body), default=0)
+    header = [row + [""] * (n_columns - len(row)) for row in header]
+    body = [row + [""] * (n_columns - len(row)) for row in body]
+    if not header:
+        columns = None
+    elif len(header) == 1:
+        columns = header[0]
+    else:
+        columns = pd.MultiIndex.from_arrays(header)
+    return pd.DataFrame(body, columns=columns)
+
+
+def _get_coordinates(pmcid: int, all_tables: dict[str, bytes]) -> pa.Table:
     all_coordinates = []
-    for table_file in tables_dir.glob("*.html"):
-        table_id = all_table_ids[table_file.stem]
+    for table_id, table_html in all_tables.items():
         try:
-            table = pd.read_html(table_file.read_text("UTF-8"))[0]
+            table = _parse_table(table_html)
             coords = _coordinates._extract_coordinates_from_table(table)
         except Exception:
             continue
-        coords["table_id"] = table_id
-        coords["pmcid"] = pmcid
+        if coords.empty:
+            continue
+        # columns in _COORD_FIELDS order so the concatenation needs no reindex
+        coords.insert(0, "table_id", table_id)
+        coords.insert(0, "pmcid", pmcid)
         all_coordinates.append(coords)
     if all_coordinates:
-        result = pd.concat(all_coordinates).loc[:, _COORD_FIELDS]
+        result = pd.concat(all_coordinates, ignore_index=True)
     else:
         result = pd.DataFrame(columns=_COORD_FIELDS)
     logging.debug(f"Found {result.shape[0]} coordinates for PMCID {pmcid}")
-    coordinates_file = output_dir / f"pmcid_{pmcid}_coordinates.csv"
-    result.to_csv(coordinates_file, index=False)
-    return coordinates_file
+    return pa.Table.from_pandas(
+        result, schema=_COORD_SCHEMA, preserve_index=False
+    )
 
 
-def _process_pmcid(
-    pmcid: int, session: requests.Session, output_dir: pathlib.Path
-) -> pathlib.Path:
-    logging.info(f"Processing PMCID {pmcid}")
-    html_file = _get_article(pmcid, session, output_dir)
-    tables_dir = _get_tables(pmcid, html_file, session, output_dir)
-    coords_file = _get_coordinates(pmcid, tables_dir, output_dir)
-    return coords_file
+def _serialize_coordinates(coordinates: pa.Table) -> bytes:
+    stream = pa.BufferOutputStream()
+    pa.parquet.write_table(coordinates, stream, compression="zstd")
+    return stream.getvalue().to_pybytes()
+
+
+def _deserialize_coordinates(data: bytes) -> pa.Table:
+    return pa.parquet.read_table(pa.BufferReader(data), schema=_COORD_SCHEMA)
+
+
+async def _process_pmcid(
+    pmcid: int, downloader: _Downloader, cache: sqlite3.Connection
+) -> pa.Table:
+    logging.debug(f"Processing PMCID {pmcid}")
+    cached = cache.execute(
+        "SELECT parquet FROM coordinates WHERE pmcid = ?", (pmcid,)
+    ).fetchone()
+    if cached is not None:
+        logging.debug(f"Coordinates for PMCID {pmcid} already extracted")
+        return _deserialize_coordinates(cached[0])
+    all_table_ids = await _get_table_ids(pmcid, downloader, cache)
+    all_tables = await _get_tables(pmcid, all_table_ids, downloader, cache)
+    coords = await asyncio.to_thread(_get_coordinates, pmcid, all_tables)
+    cache.execute(
+        "INSERT OR REPLACE INTO coordinates VALUES (?, ?)",
+        (pmcid, _serialize_coordinates(coords)),
+    )
+    return coords
+
+
+async def _try_process_pmcid(
+    pmcid: int, downloader: _Downloader, cache: sqlite3.Connection
+) -> Optional[pa.Table]:
+    try:
+        return await _process_pmcid(pmcid, downloader, cache)
+    except Exception:
+        logging.exception(f"Failed to process PMCID {pmcid}")
+        return None
+
+
+class _Progress:
+    """Count processed PMCIDs and errors and log them.
+
+    Progress is logged every `_PROGRESS_LOG_INTERVAL` PMCIDs, when the last
+    one is done, and otherwise at most every `_PROGRESS_LOG_PERIOD` seconds
+    so that slow, rate-limited runs still report progress regularly.
+    """
+
+    def __init__(self, n_pmcids: int) -> None:
+        self.n_pmcids = n_pmcids
+        self.n_done = 0
+        self.n_errors = 0
+        self._log_progress = logging.getLogger().isEnabledFor(logging.INFO)
+        self._last_log = time.monotonic()
+
+    def update(self, success: bool) -> None:
+        self.n_done += 1
+        if not success:
+            self.n_errors += 1
+        if not self._log_progress:
+            return
+        now = time.monotonic()
+        if (
+            self.n_done % _PROGRESS_LOG_INTERVAL == 0
+            or self.n_done == self.n_pmcids
+            or now - self._last_log >= _PROGRESS_LOG_PERIOD
+        ):
+            self._last_log = now
+            logging.info(
+                f"Processed {self.n_done} / {self.n_pmcids} PMCIDs "
+                f"({self.n_errors} errors)"
+            )
+
+
+async def _process_queued_pmcids(
+    pmcid_queue: asyncio.Queue[tuple[int, int]],
+    results: list[Optional[pa.Table]],
+    progress: _Progress,
+    downloader: _Downloader,
+    cache: sqlite3.Connection,
+) -> None:
+    # each worker finishes a PMCID (article and tables) before taking the
+    # next one, so only a bounded number of PMCIDs are in progress at a time
+    while True:
+        try:
+            pmcid_idx, pmcid = pmcid_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        results[pmcid_idx] = await _try_process_pmcid(
+            pmcid, downloader, cache
+        )
+        progress.update(results[pmcid_idx] is not None)
+
+
+async def _download_all_pmcids(
+    all_pmcids: list[int],
+    cache: sqlite3.Connection,
+    requests_per_second: float,
+) -> list[Optional[pa.Table]]:
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_WORKERS)
+    )
+    connector = aiohttp.TCPConnector(
+        limit=_CONNECTION_POOL_SIZE,
+        limit_per_host=_MAX_CONCURRENT_REQUESTS,
+        keepalive_timeout=_KEEPALIVE_TIMEOUT,
+    )
+    async with aiohttp.ClientSession(
+        headers=_HEADERS,
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=_REQUEST_TIMEOUT),
+    ) as session:
+        downloader = _Downloader(session, requests_per_second)
+        pmcid_queue: asyncio.Queue[tuple[int, int]] = asyncio.Queue()
+        for pmcid_idx, pmcid in enumerate(all_pmcids):
+            pmcid_queue.put_nowait((pmcid_idx, pmcid))
+        results: list[Optional[pa.Table]] = [None] * len(all_pmcids)
+        progress = _Progress(len(all_pmcids))
+        await asyncio.gather(
+            *(
+                _process_queued_pmcids(
+                    pmcid_queue, results, progress, downloader, cache
+                )
+                for _ in range(_MAX_CONCURRENT_REQUESTS)
+            )
+        )
+        return results
 
 
 def _process_all_pmcids(
-    all_pmcids: list[int], output_dir: pathlib.Path
+    all_pmcids: list[int],
+    output_dir: pathlib.Path,
+    requests_per_second: float = _REQUESTS_PER_SECOND,
 ) -> pathlib.Path:
     output_dir.mkdir(exist_ok=True, parents=True)
     logging.info(f"Collecting data for {len(all_pmcids)} PMCIDs")
     logging.info(f"Storing results in '{output_dir}'")
-    all_coords_files = []
-    n_errors = 0
-    with requests.Session() as session:
-        session.headers.update(_HEADERS)
-        for pmcid_idx, pmcid in enumerate(all_pmcids):
-            try:
-                all_coords_files.append(
-                    _process_pmcid(pmcid, session, output_dir)
-                )
-            except Exception:
-                n_errors += 1
-                logging.exception(f"Failed to process PMCID {pmcid}")
-            logging.info(
-                f"Processed {pmcid_idx + 1} / {len(all_pmcids)} PMCIDs "
-                f"({n_errors} errors)"
-            )
-    all_coords = []
-    for coords_file in all_coords_files:
-        all_coords.append(pd.read_csv(coords_file))
+    with contextlib.closing(_open_cache(output_dir)) as cache:
+        results = asyncio.run(
+            _download_all_pmcids(all_pmcids, cache, requests_per_second)
+        )
+    all_coords = [coords for coords in results if coords is not None]
+    n_errors = len(results) - len(all_coords)
     merged_coords_file = output_dir / "all_coordinates.csv"
-    merged_coords = pd.concat(all_coords)
+    merged_coords = pa.concat_tables(
+        [_COORD_SCHEMA.empty_table(), *all_coords]
+    ).to_pandas()
     n_coords = merged_coords.shape[0]
     n_articles = len(pd.unique(merged_coords["pmcid"].values))
     n_successes = len(all_pmcids) - n_errors
@@ -198,12 +617,21 @@ if __name__ == "__main__":
         help="Directory where to store outputs "
         "(will be created if necessary).",
     )
+    parser.add_argument(
+        "--requests_per_second",
+        type=float,
+        default=_REQUESTS_PER_SECOND,
+        help="Average number of requests sent to PMC per second "
+        f"(default: {_REQUESTS_PER_SECOND}).",
+    )
     args = parser.parse_args()
 
     with open(args.pmcids_file) as stream:
         pmcids = list(map(int, stream))
 
     output_dir = pathlib.Path(args.output_dir)
-    coords_file = _process_all_pmcids(pmcids, output_dir)
+    coords_file = _process_all_pmcids(
+        pmcids, output_dir, args.requests_per_second
+    )
 
     print(f"{coords_file}")